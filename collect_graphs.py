@@ -6,13 +6,18 @@ import itertools
 import re
 import sys
 import os.path
+from concurrent.futures import ProcessPoolExecutor
+from typing import ClassVar
 from typing import Dict
+from typing import List
 from typing import Optional
+from typing import Tuple
 
 # TODO: Fix issue with removed 'data.' in modules
 
 
 label_re = re.compile(r'label = "(.*)\.([^."]*)"')
+node_re = re.compile(r'"\[root\] [^"]*" \[[^]]*\]$')
 label_format = ('label=<'
                 '<table border="0">'
                 '<tr><td>'
@@ -22,49 +27,57 @@ label_format = ('label=<'
                 '</table>>')
 
 unwanted_patterns = (
-    re.compile(r'^.* -> "\[[^]]*\] provider\.aws'),  # aws_provider_link
-    re.compile(r'^.* -> "\[[^]]*\] var\.default_tags'),  # default_tags_link
-    #re.compile(r'^.* -> "\[[^]]*\] (module\.[^.]*\.)*var\.tags'),  # default_tags_link
-    re.compile(r'.*var\.tags.*'),  # default_tags_link
+    r'^.* -> "\[[^]]*\] provider\.aws',  # aws_provider_link
+    r'^.* -> "\[[^]]*\] var\.default_tags',  # default_tags_link
+    #r'^.* -> "\[[^]]*\] (module\.[^.]*\.)*var\.tags',  # default_tags_link
+    r'.*var\.tags.*',  # default_tags_link
 
-    re.compile(r'^.*] provider\.aws \(close\)'),
-    re.compile(r'^.*] meta\.count-boundary \(EachMode fixup\)'),
+    r'^.*] provider\.aws \(close\)',
+    r'^.*] meta\.count-boundary \(EachMode fixup\)',
 
-    re.compile(r'^.*] root" -> '),
+    r'^.*] root" -> ',
 )
+unwanted_re = re.compile('|'.join(f'(?:{p})' for p in unwanted_patterns))
+# Every unwanted pattern contains one of these, lines without them skip the regex
+unwanted_substrings = ('provider.aws', 'var.', 'meta.count-boundary', 'root" -> ')
 
 
 class Node:
 
-    node_line = re.compile(r'"\[root\] (?P<name>[^"]*)" \[(?P<attributes>[^]]*)\]')
-    attribute_sep = re.compile(r' *, *')
-    key_value_sep = re.compile(r' *= *')
+    __slots__ = ('name', 'graph', 'label', 'attributes')
 
-    def __init__(self, name: str, attributes: str, graph):
+    def __init__(self, name: str, attributes: str, graph: 'Graph'):
         self.name = name
         self.graph = graph
 
-        attribute_map = self._parse_attributes(attributes)
+        # Attributes are only ever written back out in order, a list of pairs
+        # is much smaller than a dict
+        label = None
+        self.attributes: List[Tuple[str, str]] = []
+        for key, value in self._parse_attributes(attributes):
+            if key == 'label':
+                label = value
+            else:
+                self.attributes.append((key, value))
 
-        self.label = attribute_map.pop('label')
+        if label is None:
+            raise KeyError('label')
 
-        self.attributes = attribute_map
+        self.label = label
 
-    @classmethod
-    def valid_line(cls, line: str) -> Optional[re.Match]:
-        # print(cls.__name__)
-        return cls.node_line.fullmatch(line)
+    def _parse_attributes(self, line: str) -> List[Tuple[str, str]]:
+        pairs = []
+        for pair in line.split(','):
+            key, separator, value = pair.partition('=')
+            if not separator:
+                raise ValueError(f'Invalid attribute: {pair!r}')
 
-    @classmethod
-    def from_match(cls, match, graph):
-        return cls(**match.groupdict(), graph=graph)
+            pairs.append((key.strip(), value.strip()))
 
-    def _parse_attributes(self, line: str):
-        return dict(self.key_value_sep.split(pair)
-                    for pair in self.attribute_sep.split(line))
+        return pairs
 
     def attributes_as_str(self) -> str:
-        return ','.join('='.join(p) for p in self.attributes.items())
+        return ','.join(f'{key}={value}' for key, value in self.attributes)
 
     def __str__(self) -> str:
         return f'"[{self.graph.name}] {self.name}" [label={self.label},{self.attributes_as_str()}]'
@@ -72,7 +85,9 @@ class Node:
 
 class Resource(Node):
 
-    colors = {
+    __slots__ = ('resource', 'key', 'is_data', 'module_name')
+
+    colors: ClassVar[Dict[str, str]] = {
         'iam_role_policy_attachment': 'orange1',
         'iam_policy_document': 'orange1',
         'iam_policy': 'orange2',
@@ -106,25 +121,27 @@ class Resource(Node):
         'cloudwatch_event_rule': 'purple1',
     }
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, name: str, attributes: str, graph: 'Graph'):
+        super().__init__(name, attributes, graph)
 
-        label_parts = self.label[1:-1].split('.')
-        self.resource, self.key = label_parts[-2:]
+        # [prefix.]resource.key, where prefix is e.g. 'data' or 'module.<name>'
+        prefix, _, self.key = self.label[1:-1].rpartition('.')
+        prefix, _, self.resource = prefix.rpartition('.')
 
-        if self.resource.startswith('aws_'):
+        if self.resource[:4] == 'aws_':
             self.resource = self.resource[4:]
 
-        self.is_data = len(label_parts) == 3 and label_parts[0] == 'data'
+        self.is_data = prefix == 'data'
 
-        if len(label_parts) == 4:
-            self.module_name = label_parts[1]
+        _module, separator, module_name = prefix.partition('.')
+        if separator and '.' not in module_name:
+            self.module_name = module_name
 
-    def color(self, resource_name):
+    def color(self, resource_name: str) -> str:
         return self.colors.get(resource_name, 'gray40')
 
     @property
-    def label_formatted(self):
+    def label_formatted(self) -> str:
         type_indicator = '<font color="gray60" point-size="9">data.</font>' if self.is_data else ''
         return ('<'
                 '<table border="0">'
@@ -135,53 +152,54 @@ class Resource(Node):
                 f'<tr><td>{self.key}</td></tr>'
                 '</table>>')
 
-    def __str__(self):
+    def __str__(self) -> str:
         return f'"[{self.graph.name}] {self.name}" [label={self.label_formatted},{self.attributes_as_str()}]'
 
 
 class Variable(Resource):
-    node_line = re.compile(r'"\[root\] (?P<name>var\.[^"]*)" \[(?P<attributes>[^]]*)\]')
+    __slots__ = ()
 
 
 class Provider(Resource):
-    @classmethod
-    def valid_line(cls, line: str) -> Optional[re.Match]:
-        return 'label = "provider.' in line
+    __slots__ = ()
 
 
 class Output(Node):
-    @classmethod
-    def valid_line(cls, line: str) -> Optional[re.Match]:
-        return 'label = "output.' in line
+    __slots__ = ()
 
 
 class Edge:
-    edge_line = re.compile(r'"\[root\] (?P<from_name>[^"]*)" -> "\[root\] (?P<to_name>[^"]*)"')
+    __slots__ = ('from_name', 'to_name', 'graph')
 
-    def __init__(self, from_name, to_name, graph):
+    edge_line: ClassVar[re.Pattern] = re.compile(r'\s*"\[root\] (?P<from_name>[^"]*)" -> "\[root\] (?P<to_name>[^"]*)"\s*$')
+
+    def __init__(self, from_name: str, to_name: str, graph: 'Graph'):
         self.from_name = from_name
         self.to_name = to_name
 
         self.graph = graph
 
-    def __str__(self):
+    def __str__(self) -> str:
         return f'"[{self.graph.name}] {self.from_name}":e -> "[{self.graph.name}] {self.to_name}":w'
 
-    @classmethod
-    def valid_line(cls, line: str) -> Optional[re.Match]:
-        # print(cls.__name__)
-        return cls.edge_line.fullmatch(line)
 
-    @classmethod
-    def from_match(cls, match, graph):
-        return cls(**match.groupdict(), graph=graph)
+class Graph:
 
+    __slots__ = ('name', 'label', 'nodes', 'edges', 'modules')
 
-class Graph:
+    # Nodes with their optional module path, in a single pass.
+    # Lines are matched unstripped, including their indentation.
+    node_line: ClassVar[re.Pattern] = re.compile(
+        r'\s*"\[root\] '
+        r'(?P<name>(?:(?P<module_name>(module\.[^.]*\.)+)|(?P<kind>[^".]*))[^"]*)" \[(?P<attributes>[^]]*)\]'
+        r'\s*$')
 
-    module_line = re.compile(r'"\[root\] (?P<module_name>(module\.[^.]*\.)+)(?P<name>[^"]*)" \[(?P<attributes>[^]]*)\]')
+    # Node class by the first dotted part of the node name, Resource otherwise
+    node_classes: ClassVar[Dict[str, type]] = {
+        'var': Variable,
+    }
 
-    NODE_CLASSES = [
+    NODE_CLASSES: ClassVar[List[type]] = [
         Resource,
         Variable,
         Provider,
@@ -191,41 +209,44 @@ class Graph:
         self.name = name
         self.label = label
 
-        self.nodes = []
-        self.edges = []
-        self.modules = {}
+        # Nodes and edges are kept as their rendered DOT lines
+        self.nodes: List[str] = []
+        self.edges: List[str] = []
+        self.modules: Dict[str, Graph] = {}
 
 
     @classmethod
-    def from_file(cls, filepath: str):
+    def from_file(cls, filepath: str) -> 'Graph':
         basename = os.path.basename(filepath)
         root, _extension = os.path.splitext(basename)
 
         with open(filepath, "r") as graph_file:
-            filecontent = graph_file.readlines()
+            filecontent = graph_file.read().splitlines()
 
         graph = cls(name=root)
 
         for line in filecontent[4:-2]:
-            line = line.strip()
             # print(line)
             if not wanted_line(line):
                 continue
 
-            match = Edge.valid_line(line)
-            if match:
-                edge = Edge.from_match(match, graph=graph)
-                graph.edges.append(edge)
+            # Most lines are nodes, only try the edge pattern when it can match
+            if ' -> ' in line:
+                match = Edge.edge_line.match(line)
+                if match:
+                    edge = Edge(match['from_name'], match['to_name'], graph=graph)
+                    graph.edges.append(str(edge))
+
+                    continue
 
+            match = cls.node_line.match(line)
+            if not match:
                 continue
 
-            node = None
             module = graph
 
-            match = cls.module_line.fullmatch(line)
-            if match:
-                module_path = match['module_name']
-
+            module_path = match['module_name']
+            if module_path:
                 # Remove leading 'module.' and trailing '.'
                 module_names = list(filter(None, module_path[7:-1].split(".module.")))
                 #print(module_names, list(module.modules.keys()))
@@ -237,40 +258,31 @@ class Graph:
                         module.modules[sub_module_name] = Graph(name=graph.name + ":" + sub_module_name, label=sub_module_name)
                         module = module.modules[sub_module_name]
 
-            for node_class in [Variable, Resource]:
-                match = node_class.valid_line(line)
-                if match:
-                    node = node_class.from_match(match, graph=graph)
-                    break
-
-
-            if node:
-                module.nodes.append(node)
+            node_class = cls.node_classes.get(match['kind'], Resource)
+            node = node_class(match['name'], match['attributes'], graph=graph)
+            module.nodes.append(str(node))
 
         return graph
 
         #map(split_label, map(remove_aws, filter(wanted_line, filecontent[4:-2]))),
 
-    def __str__(self):
+    def __str__(self) -> str:
         label = self.label or self.name
-        return "\n".join([
-            f'subgraph "cluster_{self.name}" {{',
-            f'\tlabel = "{label}";',
-            '',
-            '\t' + '\n\t'.join(map(str, self.modules.values())),
-            '',
-            '\t' + '\n\t'.join(map(str, self.nodes)),
-            '',
-            '\t' + '\n\t'.join(map(str, self.edges)),
-            '}',
-        ])
+        entries = itertools.chain(map(str, self.modules.values()),
+                                  self.nodes,
+                                  self.edges)
+        return (f'subgraph "cluster_{self.name}" {{\n'
+                f'\tlabel = "{label}";\n'
+                '\n'
+                '\t' + '\n\t'.join(entries) + '\n'
+                '}')
 
 
 def wanted_line(line: str) -> bool:
-    if any(p.match(line) for p in unwanted_patterns):
-        return False
+    if not any(s in line for s in unwanted_substrings):
+        return True
 
-    return True
+    return unwanted_re.match(line) is None
 
     #match = aws_provider_link.match(line)
     #if match:
@@ -283,8 +295,7 @@ def is_edge(line: str) -> bool:
     return ' -> ' in line
 
 def is_node(line: str) -> bool:
-    match = re.compile(r'"\[root\] [^"]*" \[[^]]*\]').fullmatch(line)
-    return match is not None
+    return node_re.match(line) is not None
 
 
 def split_label(line: str) -> str:
@@ -298,23 +309,38 @@ def remove_aws(line: str) -> str:
 
 
 
+def render_file(filepath: str) -> str:
+    # Returning the DOT text is much cheaper to pass between processes than
+    # the Graph itself
+    return str(Graph.from_file(filepath))
+
+
 def main() -> None:
-    subgraphs = [Graph.from_file(filepath) for filepath in sys.argv[1:]]
-
-    print('digraph root {\n'
-          '\tcompound = "true";\n'
-          '\tnewrank = "true";\n'
-          '\tsplines = "true";\n'
-          '\tgraph[style = solid, fontname = "helvetica", fontsize = 12, rankdir = "LR"]\n',
-          '\tedge[arrowsize = 0.6];\n'
-          '\tnode[fontname = "helvetica", fontsize = 10]',
-          )
-    print("\n".join(map(str, subgraphs)))
-    print(
+    header = ('digraph root {\n'
+              '\tcompound = "true";\n'
+              '\tnewrank = "true";\n'
+              '\tsplines = "true";\n'
+              '\tgraph[style = solid, fontname = "helvetica", fontsize = 12, rankdir = "LR"]\n'
+              '\tedge[arrowsize = 0.6];\n'
+              '\tnode[fontname = "helvetica", fontsize = 10]')
+    footer = (
         #'"[bootstrap] aws_s3_bucket.terraform_state_storage" -> "[xandr-integration] root"'
         '\t"[xandr-integration] provider.terraform (close)"[label="provider.terraform"];\n'
     )
-    print("}")
+
+    filepaths = sys.argv[1:]
+    # No more workers than input files, the pool starts all of them up front
+    workers = max(1, min(len(filepaths), os.cpu_count() or 1))
+
+    sys.stdout.write(header + '\n')
+
+    # Input files are independent, render them in parallel and write each
+    # subgraph as soon as it is done
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for subgraph in executor.map(render_file, filepaths):
+            sys.stdout.write(subgraph + '\n')
+
+    sys.stdout.write(footer + '\n}\n')
 
 
 if __name__ == "__main__":